@@ -1,42 +1,274 @@
 #!/usr/bin/env python3
-import os, sys, json, hashlib, tarfile, zipfile, io, gzip, bz2, argparse, re
+import os, sys, json, hashlib, tarfile, zipfile, io, gzip, bz2, argparse, re, heapq, shutil, itertools, stat, threading, queue
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:  # optional accelerator; stdlib json is the fallback
+    orjson = None
+try:
+    import re2 as want_re  # DFA-based; used for the want() filename filter
+except ImportError:
+    want_re = re
+
 ROOT = Path(__file__).resolve().parents[1]
 DEFAULT_OSFMK = Path(os.getenv("OSFMK_ROOT", str(Path.home() / "OSFMK")))
+TOP_FILES = 50
+COPY_CHUNK = 1 << 20
+
+# Directories called out in the report (and kept in inventory.json's by_dir).
+KEY_DIRS = ['osfmk/ipc','osfmk/vm','osfmk/kern','osfmk/arm','osfmk/i386','bsd','iokit']
+
+# Only files with these (final) suffixes are opened as archives; everything
+# else is skipped without a probe.
+TAR_EXTS = {'.tar', '.tgz', '.tbz', '.tbz2', '.txz', '.gz', '.bz2', '.xz'}
+ZIP_EXTS = {'.zip', '.jar', '.ipa', '.whl', '.egg'}
+
+# Same result as Path(name).suffix.lower() without building a Path. Trees have
+# only a few dozen distinct extensions, so the lowercased forms are cached.
+_EXT_CACHE = {}
+
+def file_ext(name: str) -> str:
+    head, _, tail = name.rpartition('.')
+    if not (head and tail):
+        return ''
+    ext = _EXT_CACHE.get(tail)
+    if ext is None:
+        ext = _EXT_CACHE[tail] = '.' + tail.lower()
+    return ext
+
+def archive_kind(name: str):
+    ext = file_ext(name)
+    if ext in TAR_EXTS:
+        return 'tar'
+    if ext in ZIP_EXTS:
+        return 'zip'
+    return None
+
+# Extract mode keeps .h/.defs members that sit under a core OSFMK tree
+# *and* a mach/ipc/vm/kern subdirectory, in either order along the path.
+# Matching is done on bytes: tarfile surrogate-escapes non-UTF-8 member
+# names, which re2 refuses to encode, while surrogateescape round-trips them.
+FOCUS_EXTS = ('.h', '.defs')
+_CORE = rb"(?:osfmk|mach_kernel|osf\.mk|osfmk-src|osfmk-export)"
+_SUB = rb"/(?:mach|ipc|vm|kern)/"
+_WANT_PAT = rb"(?s)" + _CORE + rb".*?" + _SUB + rb"|" + _SUB + rb".*?" + _CORE
+if want_re is re:
+    _WANT_RE = re.compile(_WANT_PAT)
+else:
+    # re2 treats bytes as UTF-8 by default; Latin-1 makes every byte one
+    # character, the same as stdlib re on bytes.
+    _opts = want_re.Options()
+    _opts.encoding = want_re.Options.Encoding.LATIN1
+    _WANT_RE = want_re.compile(_WANT_PAT, _opts)
+
+def want(name: str) -> bool:
+    lname = name.lower()
+    return (lname.endswith(FOCUS_EXTS)
+            and _WANT_RE.search(lname.encode('utf-8', 'surrogateescape')) is not None)
+
+def dump_json(obj, path: Path):
+    if orjson is not None:
+        # orjson rejects the surrogate escapes scandir/tarfile produce for
+        # non-UTF-8 filenames; stdlib json escapes them, so fall back.
+        try:
+            path.write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+            return
+        except orjson.JSONEncodeError:
+            pass
+    with open(path, 'w') as f:
+        json.dump(obj, f, indent=2)
 
 def sha256sum(path: Path) -> str:
-    h = hashlib.sha256()
     with open(path, 'rb') as f:
-        for chunk in iter(lambda: f.read(8192), b''):
+        # file_digest (3.11+) hashes straight from the fd in C; older
+        # interpreters fall back to large reads to keep Python overhead low.
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        h = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1 << 20), b''):
             h.update(chunk)
     return h.hexdigest()
 
-def walk(root: Path):
+# hashlib drops the GIL while digesting, so a thread pool overlaps both the
+# reads and the hashing across files.
+def hash_many(paths, workers=None) -> dict:
+    paths = list(paths)
+    if workers is None:
+        workers = min(32, (os.cpu_count() or 1) * 2)
+    with ThreadPoolExecutor(workers) as ex:
+        return dict(zip(paths, ex.map(sha256sum, paths)))
+
+# One directory listing: ([DirEntry] of regular files, [subdir paths]), without
+# following symlinks. The entries carry readdir's type info and cache their
+# stat() result. files is None if the directory can't be read.
+def _list_dir(top: str):
+    files, subdirs = [], []
+    try:
+        with os.scandir(top) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    files.append(entry)
+    except OSError:
+        return None, []
+    return files, subdirs
+
+# os.walk() replacement built on scandir: yields (dirpath, [DirEntry]) for the
+# regular files of each directory, top-down.
+def _scan(top: str):
+    files, subdirs = _list_dir(top)
+    if files is None:
+        return
+    yield top, files
+    for d in subdirs:
+        yield from _scan(d)
+
+# Same contract as _scan(), but directories are listed by `threads` workers
+# pulling from a shared LIFO stack, so scandir latency (NFS, cold disks)
+# overlaps. With stat_files, workers also lstat() each file so the cached
+# DirEntry.stat() result is ready for the consumer; files that fail are
+# dropped. Directory order is not deterministic. The result queue is bounded
+# so workers can't run ahead of a slow consumer and hold the whole tree in
+# memory, and workers stop as soon as the consumer goes away.
+def _scan_parallel(top: str, threads: int, stat_files: bool = False):
+    pending = [top]
+    busy = 0
+    cond = threading.Condition()
+    stop = threading.Event()
+    results = queue.Queue(maxsize=threads * 4)
+
+    def put(item):
+        # Give up once the consumer has stopped reading.
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def worker():
+        nonlocal busy
+        try:
+            while True:
+                with cond:
+                    while not pending and busy and not stop.is_set():
+                        cond.wait()
+                    if stop.is_set() or not pending:
+                        cond.notify_all()
+                        return
+                    d = pending.pop()
+                    busy += 1
+                subdirs = []
+                try:
+                    files, subdirs = _list_dir(d)
+                    if files is not None:
+                        if stat_files:
+                            files = [e for e in files if _prime_stat(e)]
+                        put((d, files))
+                finally:
+                    with cond:
+                        pending.extend(subdirs)
+                        busy -= 1
+                        cond.notify_all()
+        finally:
+            put(None)
+
+    for _ in range(threads):
+        threading.Thread(target=worker, daemon=True).start()
+    done = 0
+    try:
+        while done < threads:
+            item = results.get()
+            if item is None:
+                done += 1
+            else:
+                yield item
+    finally:
+        stop.set()
+        with cond:
+            cond.notify_all()
+
+def _prime_stat(entry) -> bool:
+    try:
+        entry.stat(follow_symlinks=False)
+    except OSError:
+        return False
+    return True
+
+def scan(top: str, threads: int = 1, stat_files: bool = False):
+    return _scan_parallel(top, threads, stat_files) if threads > 1 else _scan(top)
+
+# First entries of an archive for the audit summary, or None if it can't be read.
+def archive_entries(path: str, kind: str, limit: int = 50):
+    try:
+        if kind == 'tar':
+            with tarfile.open(path, 'r|*') as tf:
+                return [m.name for m in itertools.islice(tf, limit)]
+        with zipfile.ZipFile(path) as zf:
+            return zf.namelist()[:limit]
+    except Exception:
+        return None
+
+# When an `archives` list is given, archive summaries are collected during the
+# same traversal instead of walking the tree a second time. When `by_dir_out`
+# is given, per-directory totals are written to it as JSON lines as each
+# directory finishes, and only KEY_DIRS are kept in the returned stats.
+def walk(root: Path, archives: list = None, by_dir_out=None, threads: int = 1):
+    root_str = str(root)
     stats = {
-        'root': str(root),
+        'root': root_str,
         'total_files': 0,
         'by_ext': {},
         'by_dir': {},
         'top_files': [],
     }
-    for p, _, files in os.walk(root):
-        pth = Path(p)
-        rel = str(pth.relative_to(root))
-        for fn in files:
-            fp = pth / fn
+    by_ext = Counter()
+    by_dir = stats['by_dir']
+    top = []  # min-heap of the TOP_FILES largest (size, path)
+    plen = len(os.path.join(root_str, ''))
+    # Hot-loop names bound to locals (LOAD_FAST instead of global/attr lookups).
+    ext_of, kind_of, is_reg = file_ext, archive_kind, stat.S_ISREG
+    push, pushpop, ntop = heapq.heappush, heapq.heappushpop, TOP_FILES
+    for p, entries in scan(root_str, threads, stat_files=True):
+        rel = p[plen:] or '.'
+        nfiles = nbytes = 0
+        for entry in entries:
+            # lstat() result; also drops entries that stopped being regular
+            # files between readdir and here (d_type can be stale or absent).
             try:
-                sz = fp.stat().st_size
-            except Exception:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if not is_reg(st.st_mode):
                 continue
-            ext = fp.suffix.lower()
-            stats['total_files'] += 1
-            stats['by_ext'][ext] = stats['by_ext'].get(ext, 0) + 1
-            stats['by_dir'].setdefault(rel, {'files': 0, 'bytes': 0})
-            stats['by_dir'][rel]['files'] += 1
-            stats['by_dir'][rel]['bytes'] += sz
-            stats['top_files'].append((sz, str(fp)))
-    stats['top_files'] = [ {'bytes': b, 'path': p} for b,p in sorted(stats['top_files'], reverse=True)[:50] ]
+            sz = st.st_size
+            by_ext[ext_of(entry.name)] += 1
+            nfiles += 1
+            nbytes += sz
+            if archives is not None:
+                kind = kind_of(entry.name)
+                if kind is not None:
+                    names = archive_entries(entry.path, kind)
+                    if names is not None:
+                        archives.append({'path': entry.path, 'type': kind, 'entries': names})
+            if len(top) < ntop:
+                push(top, (sz, entry.path))
+            elif sz >= top[0][0]:
+                pushpop(top, (sz, entry.path))
+        if not nfiles:
+            continue
+        if by_dir_out is not None:
+            by_dir_out.write(json.dumps({'dir': rel, 'files': nfiles, 'bytes': nbytes}) + '\n')
+            if rel not in KEY_DIRS:
+                continue
+        by_dir[rel] = {'files': nfiles, 'bytes': nbytes}
+    stats['total_files'] = sum(by_ext.values())
+    stats['by_ext'] = dict(by_ext)
+    stats['top_files'] = [ {'bytes': b, 'path': p} for b,p in sorted(top, reverse=True) ]
     return stats
 
 MAPPINGS = {
@@ -48,32 +280,37 @@ MAPPINGS = {
 }
 
 def generate_report(osfmk_root: Path, inv: dict):
-    lines = []
-    lines.append(f"# OSFMK Audit Report\n")
-    lines.append(f"Source root: {osfmk_root}\n")
-    lines.append(f"Total files: {inv['total_files']}\n")
-    lines.append("## By Extension\n")
-    for ext, cnt in sorted(inv['by_ext'].items(), key=lambda x: (-x[1], x[0])):
-        lines.append(f"- {ext or '<none>'}: {cnt}")
-    lines.append("\n## Key Directories\n")
-    for d in ['osfmk/ipc','osfmk/vm','osfmk/kern','osfmk/arm','osfmk/i386','bsd','iokit']:
+    buf = io.StringIO()
+    w = buf.write
+    w("# OSFMK Audit Report\n\n")
+    w(f"Source root: {osfmk_root}\n\n")
+    w(f"Total files: {inv['total_files']}\n\n")
+    w("## By Extension\n\n")
+    # (-count, ext) tuples sort by count desc, then ext, without a key callback.
+    by_ext = [(-cnt, ext) for ext, cnt in inv['by_ext'].items()]
+    by_ext.sort()
+    w("".join(f"- {ext or '<none>'}: {-neg}\n" for neg, ext in by_ext))
+    w("\n## Key Directories\n\n")
+    for d in KEY_DIRS:
         if d in inv['by_dir']:
-            lines.append(f"- {d}: {inv['by_dir'][d]['files']} files, {inv['by_dir'][d]['bytes']} bytes")
-    lines.append("\n## Suggested Translation Map\n")
+            w(f"- {d}: {inv['by_dir'][d]['files']} files, {inv['by_dir'][d]['bytes']} bytes\n")
+    w("\n## Suggested Translation Map\n\n")
     for src, targets in MAPPINGS.items():
-        lines.append(f"- {src} ->")
+        w(f"- {src} ->\n")
         for t in targets:
-            lines.append(f"  - {t}")
-    lines.append("\n## Next Steps\n")
-    lines.append("- Prioritize vm/, ipc/, kern/ for translation to Rust modules.")
-    lines.append("- Extract constants and structure layouts; recreate in Rust types.")
-    lines.append("- Build unit tests around rights transitions, vm faults, and scheduling.")
-    return "\n".join(lines)
+            w(f"  - {t}\n")
+    w("\n## Next Steps\n\n")
+    w("- Prioritize vm/, ipc/, kern/ for translation to Rust modules.\n")
+    w("- Extract constants and structure layouts; recreate in Rust types.\n")
+    w("- Build unit tests around rights transitions, vm faults, and scheduling.\n")
+    return buf.getvalue()
 
 def main():
     parser = argparse.ArgumentParser(description='OSFMK audit/extract tool')
     parser.add_argument('root', nargs='?', default=str(DEFAULT_OSFMK))
     parser.add_argument('command', nargs='?', choices=['audit','extract'], default='audit')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='threads for directory listing and per-file lstat (helps on network/slow storage)')
     args = parser.parse_args()
 
     osfmk = Path(args.root)
@@ -84,81 +321,118 @@ def main():
     out_dir.mkdir(parents=True, exist_ok=True)
 
     if args.command == 'audit':
-        inv = walk(osfmk)
-        (out_dir / 'inventory.json').write_text(json.dumps(inv, indent=2))
         archives = []
-        for p, _, files in os.walk(osfmk):
-            for fn in files:
-                fp = Path(p) / fn
-                try:
-                    if tarfile.is_tarfile(fp):
-                        with tarfile.open(fp, 'r:*') as tf:
-                            names = tf.getnames()[:50]
-                            archives.append({'path': str(fp), 'type': 'tar', 'entries': names})
-                    elif zipfile.is_zipfile(fp):
-                        with zipfile.ZipFile(fp) as zf:
-                            names = zf.namelist()[:50]
-                            archives.append({'path': str(fp), 'type': 'zip', 'entries': names})
-                except Exception:
-                    continue
-        (out_dir / 'archives_summary.json').write_text(json.dumps(archives, indent=2))
+        with open(out_dir / 'inventory_by_dir.jsonl', 'w') as by_dir_out:
+            inv = walk(osfmk, archives, by_dir_out, args.threads)
+        dump_json(inv, out_dir / 'inventory.json')
+        dump_json(archives, out_dir / 'archives_summary.json')
         report = generate_report(osfmk, inv)
         rep_dir = ROOT / 'reports'
         rep_dir.mkdir(parents=True, exist_ok=True)
-        (rep_dir / 'OSFMK_AUDIT.md').write_text(report)
-        print(f"Wrote {out_dir / 'inventory.json'}, {out_dir / 'archives_summary.json'} and {rep_dir / 'OSFMK_AUDIT.md'}")
+        (rep_dir / 'OSFMK_AUDIT.md').write_text(report, errors='surrogateescape')
+        print(f"Wrote {out_dir / 'inventory.json'}, {out_dir / 'inventory_by_dir.jsonl'}, {out_dir / 'archives_summary.json'} and {rep_dir / 'OSFMK_AUDIT.md'}")
         return
 
     # extract mode
-    focus_exts = {'.h', '.defs'}
     focus_dirs = [
         'osfmk/', 'mach/', 'ipc/', 'vm/', 'kern/', 'osfmk/src', 'osfmk/src/ipc', 'osfmk/src/vm', 'osfmk/src/kern', 'osfmk/src/mach'
     ]
     ref_root = out_dir / 'reference'
     ref_root.mkdir(parents=True, exist_ok=True)
-    extracted = []
+    extracted = set()
 
-    core_dirs = re.compile(r"(osfmk|mach_kernel|osf\.mk|osfmk-src|osfmk-export)")
-    subdirs = re.compile(r"/(mach|ipc|vm|kern)/")
-    def want(name: str) -> bool:
-        lname = name.lower()
-        if not any(lname.endswith(e) for e in focus_exts):
-            return False
-        if not core_dirs.search(lname):
+    # extract_stamps.json maps each archive's path (relative to the OSFMK root)
+    # to its mtime/size and the files it produced, so unchanged archives are
+    # not decompressed again on re-runs. Loaded once here and rewritten once
+    # after the loop with just the archives seen this run.
+    stamps_path = out_dir / 'extract_stamps.json'
+    try:
+        old_stamps = json.loads(stamps_path.read_text())
+    except (OSError, ValueError):
+        old_stamps = {}
+    if not isinstance(old_stamps, dict):
+        old_stamps = {}
+    stamps = {}
+
+    def stamp_key(fp: Path) -> str:
+        st = fp.stat()
+        return f"{st.st_mtime_ns}:{st.st_size}"
+
+    # Anything unexpected in a stamp (wrong shape, outputs gone from disk) is
+    # a cache miss, so the archive is simply extracted again.
+    def reuse_stamp(fp: Path, arc: str) -> bool:
+        try:
+            prev = old_stamps.get(arc)
+            if not isinstance(prev, dict) or prev.get('key') != stamp_key(fp):
+                return False
+            files = prev.get('files')
+            if not isinstance(files, list):
+                return False
+            if not all(isinstance(f, str) and (ref_root / f).is_file() for f in files):
+                return False
+        except Exception:
             return False
-        return bool(subdirs.search(lname))
+        stamps[arc] = prev
+        extracted.update(files)
+        return True
 
-    for p, _, files in os.walk(osfmk):
-        for fn in files:
-            fp = Path(p) / fn
-            try:
-                if tarfile.is_tarfile(fp):
-                    with tarfile.open(fp, 'r:*') as tf:
-                        for m in tf.getmembers():
-                            if not m.isreg():
-                                continue
-                            if want(m.name):
-                                data = tf.extractfile(m).read()
-                                dst = ref_root / Path(fp.stem).name / m.name
-                                dst.parent.mkdir(parents=True, exist_ok=True)
-                                dst.write_bytes(data)
-                                extracted.append(str(dst.relative_to(ref_root)))
-                elif zipfile.is_zipfile(fp):
-                    with zipfile.ZipFile(fp) as zf:
-                        for name in zf.namelist():
-                            if want(name):
-                                data = zf.read(name)
-                                dst = ref_root / Path(fp.stem).name / name
-                                dst.parent.mkdir(parents=True, exist_ok=True)
-                                dst.write_bytes(data)
-                                extracted.append(str(dst.relative_to(ref_root)))
-            except Exception:
-                continue
+    # Many members share a parent directory; only hit mkdir once per dir.
+    made = {ref_root}
+    def ensure_dir(d: Path):
+        if d not in made:
+            d.mkdir(parents=True, exist_ok=True)
+            made.add(d)
+            made.update(d.parents)
+
+    try:
+        for _, entries in scan(str(osfmk), args.threads):
+            for entry in entries:
+                kind = archive_kind(entry.name)
+                if kind is None:
+                    continue
+                fp = Path(entry.path)
+                dst_root = ref_root / Path(fp.stem).name
+                arc = str(fp.relative_to(osfmk))
+                files = []
+                try:
+                    if reuse_stamp(fp, arc):
+                        continue
+                    if kind == 'tar':
+                        with tarfile.open(fp, 'r|*') as tf:
+                            for m in tf:
+                                # TarFile caches every member it yields;
+                                # drop them so memory stays flat.
+                                tf.members = []
+                                if not m.isreg():
+                                    continue
+                                if want(m.name):
+                                    dst = dst_root / m.name
+                                    ensure_dir(dst.parent)
+                                    with tf.extractfile(m) as src, open(dst, 'wb') as out:
+                                        shutil.copyfileobj(src, out, COPY_CHUNK)
+                                    files.append(str(dst.relative_to(ref_root)))
+                    else:
+                        with zipfile.ZipFile(fp) as zf:
+                            for name in zf.namelist():
+                                if want(name):
+                                    dst = dst_root / name
+                                    ensure_dir(dst.parent)
+                                    with zf.open(name) as src, open(dst, 'wb') as out:
+                                        shutil.copyfileobj(src, out, COPY_CHUNK)
+                                    files.append(str(dst.relative_to(ref_root)))
+                    stamps[arc] = {'key': stamp_key(fp), 'files': files}
+                except Exception:
+                    continue
+                finally:
+                    extracted.update(files)
+    finally:
+        dump_json(stamps, stamps_path)
     idx = {'root': str(ref_root), 'files': sorted(extracted)}
-    (out_dir / 'reference_index.json').write_text(json.dumps(idx, indent=2))
+    dump_json(idx, out_dir / 'reference_index.json')
     rep = ROOT / 'reports' / 'OSFMK_REFERENCE_INDEX.md'
     rep.parent.mkdir(parents=True, exist_ok=True)
-    with open(rep, 'w') as f:
+    # Member names may carry surrogate-escaped non-UTF-8 bytes; write them back as-is.
+    with open(rep, 'w', errors='surrogateescape') as f:
         f.write('# OSFMK Reference Index (Extracted)\n\n')
         f.write(f'Root: {ref_root}\n\n')
         for rel in idx['files']: